@@ -1,119 +1,431 @@
+import atexit
+import itertools
 import sqlite3
-import datetime
 import os
+import pathlib
+import queue
+import threading
+import time
 import cv2
 
+# SQL used on every detection. Keeping the text byte-identical lets sqlite3
+# reuse the compiled statement from the connection's statement cache.
+_SQL_DEDUP = 'SELECT ts FROM recent_plates WHERE plate_text = ? AND ts > ?'
+_SQL_INSERT = 'INSERT INTO detections (timestamp, plate_text, confidence, image_path) VALUES (?, ?, ?, ?)'
+_SQL_RECENT_UPSERT = 'INSERT OR REPLACE INTO recent_plates (plate_text, ts) VALUES (?, ?)'
+_SQL_RECENT_PURGE = 'DELETE FROM recent_plates WHERE ts < ?'
+_SQL_HISTORY = 'SELECT timestamp, confidence FROM detections WHERE plate_text = ? ORDER BY timestamp DESC'
+
+# Upper bound on rows held for retry after failed commits, so a database
+# that stays locked cannot grow the pending list without limit.
+_MAX_PENDING = 1024
+
 class ALPRDatabase:
     """
     Handles persistent storage for the ALPR system, managing both a 
     SQLite database for metadata and local disk storage for image crops.
     """
 
-    def __init__(self, db_path="/mnt/sdcard/alpr_data/plates.db"):
+    def __init__(self, db_path="/mnt/sdcard/alpr_data/plates.db", jpeg_quality=85, max_crop_height=96,
+                 image_format="webp", webp_quality=80):
         """
         Initializes the database handler.
         :param db_path: Absolute path to the .db file on the SD card.
+        :param jpeg_quality: JPEG quality (0-100) for saved crops. Lower values
+                             write fewer bytes to the SD card.
+        :param max_crop_height: Crops taller than this (in pixels) are scaled
+                                down before encoding. None keeps full size.
+        :param image_format: "webp" (smaller files) or "jpg". Viewing WebP crops
+                             on the inspection host requires libwebp.
+        :param webp_quality: WebP quality (1-100) used when image_format="webp".
         """
+        if image_format not in ("jpg", "webp"):
+            raise ValueError(f"Unsupported image_format: {image_format!r} (expected 'jpg' or 'webp')")
         self.db_path = db_path
+        self.jpeg_quality = jpeg_quality
+        self.max_crop_height = max_crop_height
+        self.image_format = image_format
+        self.webp_quality = webp_quality
         # Define the directory for images relative to the database file
         self.img_dir = os.path.join(os.path.dirname(self.db_path), "crops")
+        # Created once here so log_detection never has to stat the SD card
+        os.makedirs(self.img_dir, exist_ok=True)
+        # Monotonic counter appended to crop filenames
+        self._seq = itertools.count()
+        # In-process dedup cache: plate_text -> time.monotonic() of last log
+        self._recent = {}
+        # Rows waiting to be written in a single transaction (see flush)
+        self._pending = []
+        self._last_commit = time.monotonic()
+        self._closed = False
+        # Separate read-only handle for history queries (opened on first use)
+        self._ro_conn = None
+        # Set once the read-only handle has failed; reads then use self.conn
+        self._ro_failed = False
         self._initialize_db()
 
+        # Disk writes happen on a background thread so the capture loop never
+        # waits on the SD card. The lock serializes use of the writer connection
+        # (self.conn); foreground reads go through the read-only connection.
+        self._lock = threading.Lock()
+        self._io_q = queue.Queue(maxsize=64)
+        self._io_thread = threading.Thread(target=self._io_worker, daemon=True)
+        self._io_thread.start()
+        atexit.register(self.close)
+
     def _initialize_db(self):
         """
         Sets up the database structure and optimizes settings for SD card use.
-        Uses a context manager (with) to ensure the connection closes automatically.
-        """
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
-            # 1. Performance Tuning: Write-Ahead Logging (WAL)
-            # This reduces disk I/O, which extends the life of the SD card.
-            cursor.execute('PRAGMA journal_mode = WAL;')
-            
-            # 2. Table Creation
-            # id: Auto-incrementing primary key for unique row identification
-            # timestamp: Uses ISO 8601 format for easy sorting/filtering
-            # plate_text: The OCR result
-            # confidence: Float representing the OCR certainty (0.0 to 1.0)
-            # image_path: Local filename of the saved crop for visual audit
+        Opens a single long-lived connection that is reused by every call,
+        so the file open and PRAGMA setup are only paid once.
+        """
+        # isolation_level=None puts the connection in autocommit mode, so each
+        # statement commits on its own without Python's implicit BEGIN.
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None,
+                                    cached_statements=256)
+        cursor = self.conn.cursor()
+
+        # 1. Performance Tuning: Page size
+        # page_size cannot change while in WAL mode, so if an older database
+        # was created with a different size, drop out of WAL and VACUUM once.
+        cursor.execute('PRAGMA page_size;')
+        if cursor.fetchone()[0] != 4096:
+            cursor.execute('PRAGMA journal_mode = DELETE;')
+            cursor.execute('PRAGMA page_size = 4096;')
+            cursor.execute('VACUUM;')
+
+        # 2. Performance Tuning: Write-Ahead Logging (WAL)
+        # This reduces disk I/O, which extends the life of the SD card.
+        cursor.execute('PRAGMA journal_mode = WAL;')
+        # NORMAL only fsyncs at checkpoints instead of on every commit, which
+        # is still corruption-safe under WAL.
+        cursor.execute('PRAGMA synchronous = NORMAL;')
+        # 64MB page cache (negative values are in KiB), temp B-trees in RAM,
+        # and memory-mapped reads to avoid read() syscalls against the card.
+        cursor.execute('PRAGMA cache_size = -65536;')
+        cursor.execute('PRAGMA temp_store = MEMORY;')
+        cursor.execute('PRAGMA mmap_size = 268435456;')
+        # Wait up to 60s for a lock instead of failing immediately.
+        cursor.execute('PRAGMA busy_timeout = 60000;')
+        # Checkpoint the WAL into the main file every ~1000 pages (~4MB) so a
+        # system that runs for days never builds up a huge .db-wal on the card.
+        cursor.execute('PRAGMA wal_autocheckpoint = 1000;')
+
+        # 3. Table Creation
+        # id: Auto-incrementing primary key for unique row identification
+        # timestamp: Unix epoch in milliseconds, so dedup is an integer compare
+        # plate_text: The OCR result
+        # confidence: Float representing the OCR certainty (0.0 to 1.0)
+        # image_path: Local filename of the saved crop for visual audit
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS detections (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp INTEGER NOT NULL,
+                plate_text TEXT NOT NULL,
+                confidence REAL,
+                image_path TEXT
+            )
+        ''')
+
+        # Databases created before the integer schema hold local-time strings
+        # ("YYYY-MM-DD HH:MM:SS.ffffff"). Convert them to epoch ms once and
+        # record that in user_version so later startups skip the scan.
+        cursor.execute('PRAGMA user_version;')
+        if cursor.fetchone()[0] < 1:
+            cursor.execute('BEGIN IMMEDIATE;')
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS detections (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    plate_text TEXT NOT NULL,
-                    confidence REAL,
-                    image_path TEXT
-                )
+                UPDATE detections
+                SET timestamp = CAST(ROUND((julianday(timestamp, 'utc') - 2440587.5) * 86400000) AS INTEGER)
+                WHERE typeof(timestamp) = 'text'
             ''')
-            
-            # 3. Indexing
-            # Speeds up queries like "Find all records for plate X" as the DB grows.
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_plate ON detections(plate_text)')
-            conn.commit()
+            cursor.execute('PRAGMA user_version = 1;')
+            cursor.execute('COMMIT;')
+
+        # 4. Indexing
+        # Speeds up queries like "Find all records for plate X" as the DB grows.
+        # Keying on (plate_text, timestamp) returns history already in time
+        # order, and MAX(timestamp) for a plate is answered from the index
+        # alone (a single descent to the end of that plate's range).
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_plate_ts ON detections(plate_text, timestamp)')
+        # Older databases may still carry these; idx_plate_ts covers every
+        # plate_text lookup, so they only add B-tree writes to each INSERT.
+        cursor.execute('DROP INDEX IF EXISTS idx_plate')
+        cursor.execute('DROP INDEX IF EXISTS idx_plate_id')
+
+        # 5. Recent sightings
+        # Holds only the latest timestamp per plate seen in the last few
+        # seconds, so the dedup check is a primary-key lookup on a table of a
+        # few dozen rows instead of a descent into the growing detections index.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS recent_plates (
+                plate_text TEXT PRIMARY KEY,
+                ts INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+
+        # Refresh planner statistics; analysis_limit keeps this cheap on big tables.
+        cursor.execute('PRAGMA analysis_limit = 400;')
+        cursor.execute('ANALYZE;')
 
     def log_detection(self, plate_text, confidence, frame_crop):
         """
         Logs detection ONLY if the plate hasn't been seen recently.
         """
+        if self._closed:
+            raise RuntimeError("ALPRDatabase is closed")
         plate_text = plate_text.upper().strip()
-        
+        now_mono = time.monotonic()
+
         # 1. Check for duplicates (De-duplication logic)
-        # We query the DB for the most recent sighting of THIS plate
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT timestamp FROM detections 
-                WHERE plate_text = ? 
-                ORDER BY id DESC LIMIT 1
-            ''', (plate_text,))
-            last_entry = cursor.fetchone()
+        # Plates logged by this process are answered from memory first, so a
+        # burst of frames for the same car never touches SQLite.
+        last_mono = self._recent.get(plate_text)
+        if last_mono is not None and now_mono - last_mono < 5:
+            print(f"Skipping duplicate: {plate_text} (seen {now_mono - last_mono:.1f}s ago)")
+            return
+
+        # Cache miss: ask recent_plates for the last sighting of THIS plate
+        # (covers detections written before this process started).
+        # CONSTRAINT: If seen within the last 5 seconds, ignore it. The window
+        # is applied in SQL, so any row returned is a duplicate.
+        # Runs on the read-only connection: under WAL it never waits on the
+        # I/O thread, which holds self._lock for the whole batch commit.
+        now_ms = int(time.time() * 1000)
+        rows = self._read(_SQL_DEDUP, (plate_text, now_ms - 5000))
+        last_entry = rows[0] if rows else None
 
         if last_entry:
-            # Parse the timestamp string back to a datetime object
-            # Format must match the one used in insertion
-            last_seen = datetime.datetime.strptime(last_entry[0], "%Y-%m-%d %H:%M:%S.%f")
-            time_diff = (datetime.datetime.now() - last_seen).total_seconds()
-            
-            # CONSTRAINT: If seen within the last 5 seconds, ignore it.
-            if time_diff < 5:
-                print(f"Skipping duplicate: {plate_text} (seen {time_diff:.1f}s ago)")
-                return
+            print(f"Skipping duplicate: {plate_text} (seen {(now_ms - last_entry[0]) / 1000:.1f}s ago)")
+            return
 
         # 2. Proceed with storage if it's a new or "old enough" detection
-        if not os.path.exists(self.img_dir):
-            os.makedirs(self.img_dir)
-
-        now = datetime.datetime.now()
-        timestamp_str = now.strftime("%Y-%m-%d %H:%M:%S.%f")
-        img_filename = f"plate_{now.strftime('%Y%m%d_%H%M%S_%f')}.jpg"
+        # Reuse the epoch timestamp plus a per-process counter so bursts within
+        # the same millisecond still get unique names, without any strftime.
+        img_filename = f"plate_{now_ms}_{next(self._seq)}.{self.image_format}"
         full_img_path = os.path.join(self.img_dir, img_filename)
 
-        success = cv2.imwrite(full_img_path, frame_crop)
+        # The crop is only kept for visual audit, so shrink large ones first;
+        # encode time and file size both scale with pixel count.
+        # INTER_AREA is the anti-aliased filter for downscaling.
+        h, w = frame_crop.shape[:2]
+        if self.max_crop_height and h > self.max_crop_height:
+            new_w = max(1, int(w * self.max_crop_height / h))
+            frame_crop = cv2.resize(frame_crop, (new_w, self.max_crop_height), interpolation=cv2.INTER_AREA)
+
+        # Encode in memory so the file is written with a single write() call.
+        # WebP is roughly 30% smaller than JPEG at the same visual quality.
+        # Progressive JPEG costs encode time without saving space at this size.
+        if self.image_format == "webp":
+            params = [cv2.IMWRITE_WEBP_QUALITY, self.webp_quality]
+        else:
+            params = [
+                cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality,
+                cv2.IMWRITE_JPEG_OPTIMIZE, 1,
+                cv2.IMWRITE_JPEG_PROGRESSIVE, 0,
+            ]
+        success, buf = cv2.imencode('.' + self.image_format, frame_crop, params)
         if not success:
-            print(f"Error: Could not write image to {full_img_path}")
+            print(f"Error: Could not encode image for {full_img_path}")
+            return
+
+        # 3. Hand the file write and row insert to the I/O thread. The row is
+        # committed together with its neighbours so the WAL commit cost is
+        # shared across a whole burst of plates.
+        self._io_q.put((full_img_path, buf.tobytes(), (now_ms, plate_text, round(confidence, 4), img_filename)))
+
+        # Remember this sighting and prune expired entries to bound memory
+        self._recent[plate_text] = now_mono
+        self._recent = {p: t for p, t in self._recent.items() if now_mono - t < 5}
+
+    def _io_worker(self):
+        """
+        Background loop that writes queued crops to disk and batches their
+        rows into the database. A None item stops the loop.
+        """
+        while True:
+            try:
+                item = self._io_q.get(timeout=0.5)
+            except queue.Empty:
+                # Idle: commit whatever is left from the last burst
+                try:
+                    with self._lock:
+                        self._flush_pending()
+                except Exception as e:
+                    print(f"Error: I/O worker flush failed: {e}")
+                continue
+
+            if item is None:
+                self._io_q.task_done()
+                return
+
+            # Never let one item kill the thread: a dead worker would leave
+            # log_detection blocked on a full queue and flush()/close() hung.
+            try:
+                self._process_item(item)
+            except Exception as e:
+                print(f"Error: I/O worker failed on {item[0]}: {e}")
+            finally:
+                self._io_q.task_done()
+
+    def _process_item(self, item):
+        """
+        Writes one crop to disk and queues its row for the next batch commit.
+        """
+        full_img_path, img_bytes, row = item
+        try:
+            with open(full_img_path, 'wb') as f:
+                f.write(img_bytes)
+        except OSError as e:
+            print(f"Error: Could not write image to {full_img_path}: {e}")
+            return
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) >= 32 or time.monotonic() - self._last_commit > 0.5:
+                self._flush_pending()
+
+    def _flush_pending(self):
+        """
+        Writes all queued rows in one transaction. Caller must hold self._lock.
+        """
+        self._last_commit = time.monotonic()
+        if not self._pending:
             return
 
+        rows, self._pending = self._pending, []
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO detections (timestamp, plate_text, confidence, image_path)
-                    VALUES (?, ?, ?, ?)
-                ''', (timestamp_str, plate_text, round(confidence, 4), img_filename))
-                conn.commit()
-                print(f"Logged: {plate_text}")
+            self._write_rows(rows)
+        except sqlite3.OperationalError as e:
+            # Locked, busy, disk full or I/O error: likely to clear, so keep
+            # the whole batch and let the next flush try again.
+            self._requeue(rows, e)
+            return
         except sqlite3.Error as e:
-            print(f"Database insertion error: {e}")
+            # Anything else is a problem with a row, not the database. Insert
+            # one at a time so only the offending row is lost.
+            print(f"Database insertion error: {e} (retrying {len(rows)} rows one at a time)")
+            for i, row in enumerate(rows):
+                try:
+                    self._write_rows([row])
+                except sqlite3.OperationalError as e:
+                    self._requeue(rows[i:], e)
+                    return
+                except sqlite3.Error as e:
+                    print(f"Database insertion error: {e} (dropping {row[1]}, crop: {row[3]})")
+                else:
+                    print(f"Logged: {row[1]}")
+            return
+
+        # Only report a plate once its file is written and its row is committed
+        for row in rows:
+            print(f"Logged: {row[1]}")
+
+    def _write_rows(self, rows):
+        """
+        Inserts rows and updates recent_plates in a single transaction,
+        rolling back and re-raising on any error. Caller must hold self._lock.
+        """
+        try:
+            self.conn.execute('BEGIN IMMEDIATE;')
+            self.conn.executemany(_SQL_INSERT, rows)
+            self.conn.executemany(_SQL_RECENT_UPSERT, [(row[1], row[0]) for row in rows])
+            # Keep recent_plates small: anything older than the dedup window is dead
+            self.conn.execute(_SQL_RECENT_PURGE, (int(time.time() * 1000) - 5000,))
+            self.conn.execute('COMMIT;')
+        except sqlite3.Error:
+            if self.conn.in_transaction:
+                self.conn.execute('ROLLBACK;')
+            raise
+
+    def _requeue(self, rows, error):
+        """
+        Puts rows back in front of anything queued since, so the next flush
+        retries them. Drops (and logs) the oldest rows past _MAX_PENDING.
+        """
+        self._pending = rows + self._pending
+        dropped = len(self._pending) - _MAX_PENDING
+        if dropped > 0:
+            lost, self._pending = self._pending[:dropped], self._pending[dropped:]
+            print(f"Database insertion error: {error} (dropping {dropped} oldest rows, crops: "
+                  f"{', '.join(row[3] for row in lost)})")
+        else:
+            print(f"Database insertion error: {error} ({len(self._pending)} rows will be retried)")
+
+    def flush(self):
+        """
+        Blocks until every queued detection is on disk and committed.
+        Called before reads and at exit.
+        """
+        if self._io_thread.is_alive():
+            self._io_q.join()
+        with self._lock:
+            self._flush_pending()
 
     def get_plate_history(self, plate_text):
         """
         Retrieves all historical sightings of a specific license plate.
         :param plate_text: The string to search for.
-        :return: A list of tuples containing (timestamp, confidence).
+        :return: A list of tuples containing (timestamp, confidence), where
+                 timestamp is Unix epoch milliseconds.
+
+        The query itself runs on the read-only connection, but it first calls
+        flush(), so it waits for the I/O queue to drain and for the pending
+        batch to commit. Do not call it from the capture loop.
+        """
+        if self._closed:
+            raise RuntimeError("ALPRDatabase is closed")
+        self.flush()
+        return self._read(_SQL_HISTORY, (plate_text.upper().strip(),))
+
+    def _read(self, sql, params):
+        """
+        Runs a SELECT and returns all rows. Uses the read-only connection when
+        it works, otherwise falls back to the writer under self._lock.
         """
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            query = "SELECT timestamp, confidence FROM detections WHERE plate_text = ? ORDER BY timestamp DESC"
-            cursor.execute(query, (plate_text.upper().strip(),))
-            return cursor.fetchall()
\ No newline at end of file
+        reader = self._get_reader()
+        if reader is not None:
+            try:
+                return reader.execute(sql, params).fetchall()
+            except sqlite3.Error as e:
+                # Some read-only open failures (e.g. an unopenable -shm file)
+                # only surface on the first query; stop using the handle.
+                print(f"Read-only connection failed, using writer from now on: {e}")
+                self._ro_failed = True
+                self._ro_conn.close()
+                self._ro_conn = None
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def _get_reader(self):
+        """
+        Returns a read-only connection to the database, opening it on first
+        use. Used for the dedup check and history reads; under WAL it reads
+        without waiting on the I/O thread's writes.
+        Returns None once it has failed, so callers fall back to self.conn.
+        """
+        if self._ro_conn is None and not self._ro_failed:
+            uri = pathlib.Path(self.db_path).resolve().as_uri() + "?mode=ro"
+            try:
+                self._ro_conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            except sqlite3.Error as e:
+                print(f"Read-only connection unavailable, using writer from now on: {e}")
+                self._ro_failed = True
+        return self._ro_conn
+
+    def close(self):
+        """
+        Checkpoints the WAL back into the main database file and closes the
+        shared connection. Registered with atexit, so calling it explicitly
+        at shutdown is optional; repeated calls are ignored.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._io_thread.is_alive():
+            self._io_q.put(None)
+            self._io_thread.join()
+        self.flush()
+        if self._ro_conn is not None:
+            self._ro_conn.close()
+            self._ro_conn = None
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+        self.conn.close()
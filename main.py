@@ -109,6 +109,7 @@ def main():
         print("\nCtrl+C detected. Shutting down gracefully...")
     finally:
         cap.release()
+        db.close()
         print("Camera released. Goodbye!")
 
 if __name__ == "__main__":
@@ -1,98 +1,282 @@
 #test duplicate of database.py to test saving function 
 
 
+import atexit
+import itertools
 import sqlite3
-import datetime
 import os
+import pathlib
+import queue
+import threading
 import cv2
 import numpy as np
 import time
 
+# SQL used on every detection. Keeping the text byte-identical lets sqlite3
+# reuse the compiled statement from the connection's statement cache.
+_SQL_DEDUP = 'SELECT ts FROM recent_plates WHERE plate_text = ? AND ts > ?'
+_SQL_INSERT = 'INSERT INTO detections (timestamp, plate_text, confidence, image_path) VALUES (?, ?, ?, ?)'
+_SQL_RECENT_UPSERT = 'INSERT OR REPLACE INTO recent_plates (plate_text, ts) VALUES (?, ?)'
+_SQL_RECENT_PURGE = 'DELETE FROM recent_plates WHERE ts < ?'
+_MAX_PENDING = 1024  # cap on rows kept for retry after failed commits
+
 # --- REVISED DATABASE CLASS ---
 class ALPRDatabase:
-    def __init__(self, db_path):
+    def __init__(self, db_path, jpeg_quality=85, max_crop_height=96, image_format="webp", webp_quality=80):
+        if image_format not in ("jpg", "webp"):
+            raise ValueError(f"Unsupported image_format: {image_format!r} (expected 'jpg' or 'webp')")
         self.db_path = db_path
+        self.jpeg_quality = jpeg_quality
+        self.max_crop_height = max_crop_height
+        self.image_format = image_format  # WebP crops need libwebp to view
+        self.webp_quality = webp_quality
         self.img_dir = os.path.join(os.path.dirname(self.db_path), "crops")
+        os.makedirs(self.img_dir, exist_ok=True)  # once, not per detection
+        self._seq = itertools.count()  # suffix for unique crop filenames
+        self._recent = {}  # plate_text -> time.monotonic() of last log
+        self._pending = []  # rows waiting for the next batched commit
+        self._last_commit = time.monotonic()
+        self._closed = False
         self._initialize_db()
 
+        # Background writer so log_detection never blocks on the SD card
+        self._lock = threading.Lock()  # guards the writer connection (self.conn)
+        self._io_q = queue.Queue(maxsize=64)
+        self._io_thread = threading.Thread(target=self._io_worker, daemon=True)
+        self._io_thread.start()
+        atexit.register(self.close)
+
     def _initialize_db(self):
         # Ensure the directory for the DB file exists
         db_folder = os.path.dirname(self.db_path)
         if not os.path.exists(db_folder):
             os.makedirs(db_folder)
 
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('PRAGMA journal_mode = WAL;')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS detections (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    plate_text TEXT NOT NULL,
-                    confidence REAL,
-                    image_path TEXT
-                )
-            ''')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_plate ON detections(plate_text)')
-            conn.commit()
+        # Single long-lived connection reused by every call (autocommit mode)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None,
+                                    cached_statements=256)
+        cursor = self.conn.cursor()
+        cursor.execute('PRAGMA page_size;')
+        if cursor.fetchone()[0] != 4096:
+            # page_size can't change under WAL, so rebuild once in rollback mode
+            cursor.execute('PRAGMA journal_mode = DELETE;')
+            cursor.execute('PRAGMA page_size = 4096;')
+            cursor.execute('VACUUM;')
+        cursor.execute('PRAGMA journal_mode = WAL;')
+        cursor.execute('PRAGMA synchronous = NORMAL;')
+        cursor.execute('PRAGMA cache_size = -65536;')
+        cursor.execute('PRAGMA temp_store = MEMORY;')
+        cursor.execute('PRAGMA mmap_size = 268435456;')
+        cursor.execute('PRAGMA busy_timeout = 60000;')
+        cursor.execute('PRAGMA wal_autocheckpoint = 1000;')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS detections (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp INTEGER NOT NULL,
+                plate_text TEXT NOT NULL,
+                confidence REAL,
+                image_path TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_plate_ts ON detections(plate_text, timestamp)')
+        cursor.execute('DROP INDEX IF EXISTS idx_plate')
+        cursor.execute('DROP INDEX IF EXISTS idx_plate_id')
+        # Tiny table of the latest sighting per plate, used for dedup
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS recent_plates (
+                plate_text TEXT PRIMARY KEY,
+                ts INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('PRAGMA analysis_limit = 400;')
+        cursor.execute('ANALYZE;')
+
+        # Read-only handle for the dedup check so it never waits on the
+        # I/O thread's batch commits (WAL readers don't block on writers)
+        uri = pathlib.Path(self.db_path).resolve().as_uri() + "?mode=ro"
+        self._ro_conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
 
     def log_detection(self, plate_text, confidence, frame_crop):
         plate_text = plate_text.upper().strip()
+        now_mono = time.monotonic()
         
         # --- LOGIC UPDATE: DE-DUPLICATION ---
+        # Check the in-memory cache first, then fall back to the DB
+        last_mono = self._recent.get(plate_text)
+        if last_mono is not None and now_mono - last_mono < 5:
+            print(f"[SKIP] Duplicate: {plate_text} (Seen {now_mono - last_mono:.2f}s ago)")
+            return # Exit function, do not save
+
         # Check if this plate was seen in the last 5 seconds
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT timestamp FROM detections 
-                WHERE plate_text = ? 
-                ORDER BY id DESC LIMIT 1
-            ''', (plate_text,))
-            last_entry = cursor.fetchone()
+        # (window applied in SQL: any row returned is a duplicate)
+        now_ms = int(time.time() * 1000)
+        last_entry = self._ro_conn.execute(_SQL_DEDUP, (plate_text, now_ms - 5000)).fetchone()
 
         if last_entry:
-            last_seen = datetime.datetime.strptime(last_entry[0], "%Y-%m-%d %H:%M:%S.%f")
-            time_diff = (datetime.datetime.now() - last_seen).total_seconds()
-            
-            if time_diff < 5:
-                print(f"[SKIP] Duplicate: {plate_text} (Seen {time_diff:.2f}s ago)")
-                return # Exit function, do not save
+            print(f"[SKIP] Duplicate: {plate_text} (Seen {(now_ms - last_entry[0]) / 1000:.2f}s ago)")
+            return # Exit function, do not save
 
         # --- SAVE IMAGE ---
-        if not os.path.exists(self.img_dir):
-            os.makedirs(self.img_dir)
-
-        now = datetime.datetime.now()
-        timestamp_str = now.strftime("%Y-%m-%d %H:%M:%S.%f")
-        img_filename = f"plate_{now.strftime('%Y%m%d_%H%M%S_%f')}.jpg"
+        img_filename = f"plate_{now_ms}_{next(self._seq)}.{self.image_format}"
         full_img_path = os.path.join(self.img_dir, img_filename)
 
-        success = cv2.imwrite(full_img_path, frame_crop)
+        # Downscale tall crops before encoding (audit copy only)
+        h, w = frame_crop.shape[:2]
+        if self.max_crop_height and h > self.max_crop_height:
+            new_w = max(1, int(w * self.max_crop_height / h))
+            frame_crop = cv2.resize(frame_crop, (new_w, self.max_crop_height), interpolation=cv2.INTER_AREA)
+
+        if self.image_format == "webp":
+            params = [cv2.IMWRITE_WEBP_QUALITY, self.webp_quality]
+        else:
+            params = [
+                cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality,
+                cv2.IMWRITE_JPEG_OPTIMIZE, 1,
+                cv2.IMWRITE_JPEG_PROGRESSIVE, 0,
+            ]
+        success, buf = cv2.imencode('.' + self.image_format, frame_crop, params)
         if not success:
-            print(f"[ERR] Failed to save image: {full_img_path}")
+            print(f"[ERR] Failed to encode image: {full_img_path}")
             return
 
-        # --- SAVE TO DB ---
+        # --- HAND OFF TO I/O THREAD (file write + batched insert) ---
+        self._io_q.put((full_img_path, buf.tobytes(), (now_ms, plate_text, round(confidence, 4), img_filename)))
+
+        self._recent[plate_text] = now_mono
+        self._recent = {p: t for p, t in self._recent.items() if now_mono - t < 5}
+
+    def _io_worker(self):
+        # Write crops and batch rows until a None sentinel arrives
+        while True:
+            try:
+                item = self._io_q.get(timeout=0.5)
+            except queue.Empty:
+                try:
+                    with self._lock:
+                        self._flush_pending()
+                except Exception as e:
+                    print(f"[ERR] I/O worker flush failed: {e}")
+                continue
+
+            if item is None:
+                self._io_q.task_done()
+                return
+
+            # Never let one item kill the thread: a dead worker would leave
+            # log_detection blocked on a full queue and flush()/close() hung.
+            try:
+                self._process_item(item)
+            except Exception as e:
+                print(f"[ERR] I/O worker failed on {item[0]}: {e}")
+            finally:
+                self._io_q.task_done()
+
+    def _process_item(self, item):
+        # Write one crop, then queue its row for the next batch commit
+        full_img_path, img_bytes, row = item
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO detections (timestamp, plate_text, confidence, image_path)
-                    VALUES (?, ?, ?, ?)
-                ''', (timestamp_str, plate_text, round(confidence, 4), img_filename))
-                conn.commit()
-                print(f"[LOG] Saved new detection: {plate_text}")
+            with open(full_img_path, 'wb') as f:
+                f.write(img_bytes)
+        except OSError as e:
+            print(f"[ERR] Failed to save image: {full_img_path} ({e})")
+            return
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) >= 32 or time.monotonic() - self._last_commit > 0.5:
+                self._flush_pending()
+
+    def _flush_pending(self):
+        # Commit every queued row in a single transaction (caller holds _lock)
+        self._last_commit = time.monotonic()
+        if not self._pending:
+            return
+
+        rows, self._pending = self._pending, []
+        try:
+            self._write_rows(rows)
+        except sqlite3.OperationalError as e:
+            # Transient (locked/busy/disk full/I/O): retry the batch next flush
+            self._requeue(rows, e)
+            return
         except sqlite3.Error as e:
-            print(f"[ERR] Database insertion error: {e}")
+            # Bad row: insert one at a time so only the offending row is lost
+            print(f"[ERR] Database insertion error: {e} (retrying {len(rows)} rows one at a time)")
+            for i, row in enumerate(rows):
+                try:
+                    self._write_rows([row])
+                except sqlite3.OperationalError as e:
+                    self._requeue(rows[i:], e)
+                    return
+                except sqlite3.Error as e:
+                    print(f"[ERR] Database insertion error: {e} (dropping {row[1]}, crop: {row[3]})")
+                else:
+                    print(f"[LOG] Saved new detection: {row[1]}")
+            return
+
+        # Only report a plate once its file is written and its row is committed
+        for row in rows:
+            print(f"[LOG] Saved new detection: {row[1]}")
+
+    def _write_rows(self, rows):
+        # One transaction for the rows plus recent_plates; rolls back and re-raises
+        try:
+            self.conn.execute('BEGIN IMMEDIATE;')
+            self.conn.executemany(_SQL_INSERT, rows)
+            self.conn.executemany(_SQL_RECENT_UPSERT, [(row[1], row[0]) for row in rows])
+            self.conn.execute(_SQL_RECENT_PURGE, (int(time.time() * 1000) - 5000,))
+            self.conn.execute('COMMIT;')
+        except sqlite3.Error:
+            if self.conn.in_transaction:
+                self.conn.execute('ROLLBACK;')
+            raise
+
+    def _requeue(self, rows, error):
+        # Requeue rows for the next flush, dropping the oldest past the cap
+        self._pending = rows + self._pending
+        dropped = len(self._pending) - _MAX_PENDING
+        if dropped > 0:
+            lost, self._pending = self._pending[:dropped], self._pending[dropped:]
+            print(f"[ERR] Database insertion error: {error} (dropping {dropped} oldest rows, crops: "
+                  f"{', '.join(row[3] for row in lost)})")
+        else:
+            print(f"[ERR] Database insertion error: {error} ({len(self._pending)} rows will be retried)")
+
+    def flush(self):
+        # Wait for the I/O thread to drain, then commit anything left
+        if self._io_thread.is_alive():
+            self._io_q.join()
+        with self._lock:
+            self._flush_pending()
+
+    def close(self):
+        # Stop the I/O thread, fold the WAL back into the main file,
+        # then release the connection. Safe to call more than once.
+        if self._closed:
+            return
+        self._closed = True
+        if self._io_thread.is_alive():
+            self._io_q.put(None)
+            self._io_thread.join()
+        self.flush()
+        self._ro_conn.close()
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+        self.conn.close()
 
 # --- TEST HARNESS ---
 
-def create_dummy_image(text):
-    """Generates a black image with the license plate text written on it."""
-    img = np.zeros((100, 300, 3), dtype=np.uint8)
-    cv2.putText(img, text, (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 
+def create_dummy_image(text, out=None):
+    """
+    Generates a black image with the license plate text written on it.
+    If `out` (a 100x300x3 uint8 array) is given it is cleared and drawn into
+    instead of allocating a new image; callers that need to keep the result
+    across calls should copy it.
+    """
+    if out is None:
+        out = np.empty((100, 300, 3), dtype=np.uint8)
+    out.fill(0)
+    cv2.putText(out, text, (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 
                 1.5, (255, 255, 255), 2, cv2.LINE_AA)
-    return img
+    return out
 
 def main():
     # 1. Setup local test path (avoiding /mnt/sdcard for desktop testing)
@@ -109,10 +293,14 @@ def main():
     print(f"Initializing Database at {test_db_path}...")
     db = ALPRDatabase(db_path=test_db_path)
 
+    # One scratch frame reused for every dummy image (log_detection encodes
+    # the crop before returning, so it is safe to redraw afterwards)
+    scratch = np.empty((100, 300, 3), np.uint8)
+
     # 2. Simulate "Plate Chatter" (Rapid fire detections of same car)
     print("\n--- TEST 1: Rapid Duplicate Detection (Car 'ABC-123') ---")
     plate_a = "ABC-123"
-    dummy_img_a = create_dummy_image(plate_a)
+    dummy_img_a = create_dummy_image(plate_a, scratch)
 
     for i in range(5):
         # Sending 5 detections in a row with slight variations in confidence
@@ -124,7 +312,7 @@ def main():
     # 3. Simulate a new car arriving
     print("\n--- TEST 2: New Car Arrives ('XYZ-999') ---")
     plate_b = "XYZ-999"
-    dummy_img_b = create_dummy_image(plate_b)
+    dummy_img_b = create_dummy_image(plate_b, scratch)
     db.log_detection(plate_b, 0.95, dummy_img_b)
 
     # 4. Simulate the first car returning after the cooldown
@@ -135,17 +323,19 @@ def main():
     time.sleep(5.1)
     
     print(f"Sending {plate_a} again...")
+    dummy_img_a = create_dummy_image(plate_a, scratch)  # scratch now holds plate_b
     db.log_detection(plate_a, 0.92, dummy_img_a)
 
     # 5. Verify contents
     print("\n--- VERIFICATION ---")
+    db.close()
     conn = sqlite3.connect(test_db_path)
     cursor = conn.cursor()
     cursor.execute("SELECT id, timestamp, plate_text, image_path FROM detections")
     rows = cursor.fetchall()
     
     print(f"Total Rows in DB: {len(rows)}")
-    print(f"{'ID':<4} {'Timestamp':<25} {'Plate':<10} {'Image File'}")
+    print(f"{'ID':<4} {'Timestamp (ms)':<25} {'Plate':<10} {'Image File'}")
     print("-" * 60)
     for row in rows:
         print(f"{row[0]:<4} {row[1]:<25} {row[2]:<10} {row[3]}")